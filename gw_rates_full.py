@@ -1,37 +1,46 @@
 #!/usr/bin/env python
-import io
+import hashlib
 import pickle
 import sys
 import os
-import random
-import time
 from functools import partial
 from urllib import parse, request
 
 import numpy as np
-import scipy.stats as spstat
 from collections import namedtuple
 from astropy.time import Time
-from astropy.coordinates import Distance
 import astropy.table as at
 import astropy.units as u, astropy.constants as c
 import argparse
-import matplotlib.pyplot as plt
-from astropy.visualization import hist
-import schwimmbad
 from scipy.linalg import cholesky
+from scipy.interpolate import RegularGridInterpolator
+from scipy.special import ndtr
+from numba import njit
 import scipy.integrate as scinteg
-from sklearn.preprocessing import MinMaxScaler
 
-import inspiral_range
 from ligo.computeDiskMass import computeCompactness, computeDiskMass
 import lalsimulation as lalsim
 from gwemlightcurves.EjectaFits import DiUj2017
 
-np.random.RandomState(int(time.time()))
-
 EOSNAME = "APR4_EPP"
 MAX_MASS = 2.21  # specific to EoS model
+# absolute magnitudes of SSS17a and the spread of kilonova peak magnitudes
+SSS17A = -16.9  # H-band
+SSS17A_F200 = -15.4591
+MINMAG = -14.7
+MAXMAG = SSS17A - 2.
+ABSM_SPAN = abs(MAXMAG - MINMAG)
+# bimodal MSP mass distribution (mean, sigma), from
+# https://arxiv.org/pdf/1605.01665.pdf
+MSP_MODES = [(1.393, 0.064), (1.807, 0.177)]
+
+# everything a Monte Carlo trial needs; must stay picklable for the pool
+TrialSetup = namedtuple('TrialSetup', ['args', 'seed', 'fractional_duration',
+                                       'upper_chol', 'phase', 'hmag',
+                                       'f200mag', 'bns_range'])
+
+# what a trial without any detections returns
+NO_DETECTIONS = (np.empty(0),)*12 + (0, 0, 0)
 
 detector_asd_links = dict(
     ligo='https://dcc.ligo.org/public/0165/T2000012/001/aligo_O4high.txt',
@@ -55,62 +64,303 @@ def has_ejecta_mass(m1, m2):
     return m_rem > 0.0
 
 
-def get_range(detector):
+def get_asd_filename(detector):
     psd_url = detector_asd_links[detector]
-    try:
-        # if downloaded locally
-        asd_fp = open(os.path.basename(parse.urlparse(psd_url).path), "rb")
-    except FileNotFoundError:
+    return os.path.basename(parse.urlparse(psd_url).path)
+
+
+def get_asd_file(detector):
+    """
+    Get the local ASD file of a detector, downloading it if needed
+    """
+    psd_url = detector_asd_links[detector]
+    asd_filename = get_asd_filename(detector)
+    if not os.path.exists(asd_filename):
         print(f"Downloading PSD for {detector}")
-        asd_fp = io.BytesIO(request.urlopen(psd_url).read())
-    freq, asd = np.loadtxt(asd_fp, unpack=True)
+        asd_data = request.urlopen(psd_url).read()
+        # keep a local copy so later runs do not download it again; write it
+        # aside first so a failed write never leaves a partial file behind
+        with open(asd_filename + ".part", "wb") as asd_fp:
+            asd_fp.write(asd_data)
+        os.replace(asd_filename + ".part", asd_filename)
+    return asd_filename
+
+
+def get_range(detector):
+    import inspiral_range
+    freq, asd = np.loadtxt(get_asd_file(detector), unpack=True)
     psd = asd**2
     return partial(inspiral_range.range, freq, psd)
 
 
-def get_correlated_series(n_events, upper_chol):
+def get_range_table(detector, m_grid):
+    """
+    Tabulate the inspiral range (Mpc) of a detector on a grid of component
+    masses. The table only depends on the PSD, so it is cached on disk and
+    reused between runs with the same PSD link, ASD contents and grid
+    """
+    psd_url = detector_asd_links[detector]
+    with open(get_asd_file(detector), "rb") as asd_fp:
+        asd_hash = hashlib.sha256(asd_fp.read()).hexdigest()
+    table_filename = os.path.splitext(get_asd_filename(detector))[0] + "_range.npz"
+    if os.path.exists(table_filename):
+        with np.load(table_filename) as cached:
+            if (str(cached['psd_url']) == psd_url and
+                    str(cached['asd_hash']) == asd_hash and
+                    np.array_equal(cached['m_grid'], m_grid)):
+                return cached['table']
+    print(f"Tabulating range for {detector}")
+    range_func = get_range(detector)
+    # the range is symmetric in (m1, m2), so only fill the upper triangle
+    # and mirror it
+    table = np.zeros((len(m_grid), len(m_grid)))
+    for i, m1 in enumerate(m_grid):
+        for j in range(i, len(m_grid)):
+            table[i, j] = range_func(m1=m1, m2=m_grid[j])
+    table = np.triu(table) + np.triu(table, 1).T
+    np.savez(table_filename, psd_url=psd_url, asd_hash=asd_hash,
+             m_grid=m_grid, table=table)
+    return table
+
+
+def get_mass_grid(args, n_grid=100):
+    """
+    Get the component masses on which to tabulate the detector ranges,
+    covering the whole of the requested mass distribution
+    """
+    if args.mass_distrib == 'flat':
+        lo = min(args.masskey1, args.masskey2)
+        hi = max(args.masskey1, args.masskey2)
+    else:
+        modes = MSP_MODES if args.mass_distrib == 'msp' else [(args.masskey1, args.masskey2)]
+        # +/- 7 sigma of every mode; masses are truncated at zero
+        lo = max(min(mean - 7.*sig for mean, sig in modes), 0.01)
+        hi = max(mean + 7.*sig for mean, sig in modes)
+    return np.linspace(lo, hi, n_grid)
+
+
+def get_range_interpolator(detectors, m_grid):
+    """
+    Get a single interpolator over (m1, m2) pairs returning the range of
+    every detector, so that all of them are looked up in one call
+    """
+    tables = np.stack([get_range_table(detector, m_grid) for detector in detectors], axis=-1)
+    # masses are clipped to the grid in dotry, so never extrapolate
+    return RegularGridInterpolator((m_grid, m_grid), tables)
+
+
+def truncnorm_positive(mean, sig, n, rng):
+    """
+    Draw from a normal distribution truncated at zero by redrawing the
+    (rare) non-positive samples
+    """
+    samples = rng.normal(mean, sig, n)
+    bad = samples <= 0
+    while bad.any():
+        samples[bad] = rng.normal(mean, sig, bad.sum())
+        bad = samples <= 0
+    return samples
+
+
+def get_correlated_series(n_events, upper_chol, rng):
     """
     Get some correlated uniformly distributed random series between 0 and 1
     """
-    rnd = np.random.uniform(0., 1., size=(n_events, 4))
-    series = rnd @ upper_chol
+    # Gaussian copula: correlate standard normals, then map each one back
+    # to a uniform marginal through the normal CDF
+    rnd = rng.standard_normal((n_events, 4), dtype=np.float32)
+    series = ndtr(rnd @ upper_chol)
     return series
 
 
-def get_sim_dutycycles(n_events, upper_chol, h_duty, l_duty, v_duty, k_duty):
+def get_sim_dutycycles(n_events, upper_chol, h_duty, l_duty, v_duty, k_duty, rng):
     """
     Get some correlated duty cycle series
     """
-    series = get_correlated_series(n_events, upper_chol)
-    scaler = MinMaxScaler()
-    scaler.fit(series)
-    series = scaler.transform(series)
-    series = series.T
-    duty_cycles = np.zeros(series.shape)
-
-    h_series = series[0,:]
-    l_series = series[1,:]
-    v_series = series[2,:]
-    k_series = series[3,:]
-
-    h_on = duty_cycles[0,:]
-    l_on = duty_cycles[1,:]
-    v_on = duty_cycles[2,:]
-    k_on = duty_cycles[3,:]
-
-    h_on[h_series <= h_duty] = 1
-    l_on[l_series <= l_duty] = 1
-    v_on[v_series <= v_duty] = 1
-    k_on[k_series <= k_duty] = 1
-
-    h_on = h_on.astype(bool)
-    l_on = l_on.astype(bool)
-    v_on = v_on.astype(bool)
-    k_on = k_on.astype(bool)
-
+    series = get_correlated_series(n_events, upper_chol, rng)
+    thresholds = np.array([h_duty, l_duty, v_duty, k_duty])
+    h_on, l_on, v_on, k_on = (series <= thresholds).T
     return h_on, l_on, v_on, k_on
 
 
+@njit(fastmath=True, cache=True)
+def observe_events(xyz, h_on, l_on, v_on, k_on, range_ligo, range_virgo,
+                   range_kagra, absm, absm_f200w):
+    """
+    Get the distance (Mpc) of each event, the number of detectors that are
+    on with the event in range, and the apparent magnitudes, in one pass
+    """
+    n_events = xyz.shape[1]
+    dist = np.empty(n_events)
+    n_detectors_on_and_obs = np.empty(n_events, dtype=np.int8)
+    obsmag = np.empty(n_events)
+    obsmagf200w = np.empty(n_events)
+    for i in range(n_events):
+        d = np.sqrt(xyz[0, i]**2 + xyz[1, i]**2 + xyz[2, i]**2 + 0.05**2)
+        in_ligo = d <= range_ligo[i]
+        n_obs = 0
+        if h_on[i] and in_ligo:
+            n_obs += 1
+        if l_on[i] and in_ligo:
+            n_obs += 1
+        if v_on[i] and d <= range_virgo[i]:
+            n_obs += 1
+        if k_on[i] and d <= range_kagra[i]:
+            n_obs += 1
+        distmod = 5.*np.log10(d) + 25.
+        dist[i] = d
+        n_detectors_on_and_obs[i] = n_obs
+        obsmag[i] = absm[i] + distmod
+        obsmagf200w[i] = absm_f200w[i] + distmod
+    return dist, n_detectors_on_and_obs, obsmag, obsmagf200w
+
+
+def dotry(n, setup):
+    """
+    Run a single Monte Carlo trial; the random generator is seeded from the
+    trial number so that trials are reproducible in any worker process
+    """
+    args = setup.args
+    rng = np.random.default_rng([n, setup.seed])
+
+    # create the mass distribution of the merging neutron star
+    mass_distrib = args.mass_distrib
+    min_mass = args.masskey1
+    max_mass = args.masskey2
+    box_size = args.box_size
+    volume = box_size**3
+
+    phase = setup.phase
+
+    # setup duty cycles
+    h_duty = args.hdutycycle
+    l_duty = args.ldutycycle
+    v_duty = args.vdutycycle
+    k_duty = args.kdutycycle
+
+    # setup event rates
+    rate = 10.**(rng.normal(args.mean_lograte, args.sig_lograte))
+    n_events = np.around(rate*volume*setup.fractional_duration).astype('int')
+    if n_events == 0:
+        return NO_DETECTIONS
+    print(f"### Num trial = {n}; Num events = {n_events}")
+    # the truncated normal distribution looks to be from:
+    # https://arxiv.org/pdf/1309.6635.pdf
+    if mass_distrib == 'mw':
+        mass1 = truncnorm_positive(args.masskey1, args.masskey2, n_events, rng)  # FIXME: Unbound local error
+        mass2 = truncnorm_positive(args.masskey1, args.masskey2, n_events, rng)
+    elif mass_distrib == 'msp':
+        print("MSP population chosen, overriding mean_mass and sig_mass if supplied.")
+        # two modes, choose a random one each time
+        mean_mass, sig_mass = MSP_MODES[rng.integers(len(MSP_MODES))]
+        mass1 = truncnorm_positive(mean_mass, sig_mass, n_events, rng)
+        mass2 = truncnorm_positive(mean_mass, sig_mass, n_events, rng)
+    else:
+        print("Flat population chosen.")
+        mass1 = rng.uniform(min_mass, max_mass, n_events)
+        mass2 = rng.uniform(min_mass, max_mass, n_events)
+    # the grid spans the mass distribution, so this only catches the
+    # vanishingly rare draws beyond 7 sigma
+    m_grid = setup.bns_range.grid[0]
+    masses = np.clip(np.stack([mass1, mass2], axis=-1), m_grid[0], m_grid[-1])
+    bns_range_ligo, bns_range_virgo, bns_range_kagra = setup.bns_range(masses).T
+    tot_mass = mass1 + mass2
+
+    delay = rng.uniform(0, 365.25, n_events)
+    delay[delay > 90] = 0
+
+    av = rng.exponential(1, n_events)*0.4
+    ah = av/6.1
+
+    # nearest tabulated epoch to each delay; phase is sorted in main
+    magindex = np.searchsorted(phase, delay)
+    np.clip(magindex, 1, len(phase) - 1, out=magindex)
+    magindex -= (delay - phase[magindex - 1]) < (phase[magindex] - delay)
+
+    absm = rng.random(n_events)*ABSM_SPAN + SSS17A + setup.hmag[magindex] + ah
+
+    absm_f200w = rng.random(n_events)*ABSM_SPAN + SSS17A_F200 + setup.f200mag[magindex]
+
+    # simulate coordinates
+    xyz = (rng.random((3, n_events)) - 0.5)*box_size
+
+    h_on, l_on, v_on, k_on = get_sim_dutycycles(n_events, setup.upper_chol,
+                                                h_duty, l_duty, v_duty, k_duty, rng)
+    # which detectors observed, and how bright the kilonova looks
+    dist, n_detectors_on_and_obs, obsmag, obsmagf200w = observe_events(
+        xyz, h_on, l_on, v_on, k_on,
+        bns_range_ligo, bns_range_virgo, bns_range_kagra,
+        absm, absm_f200w
+    )
+
+    # nothing left to count if no event was seen by at least two detectors
+    gw_detected = n_detectors_on_and_obs >= 2
+    if not gw_detected.any():
+        return NO_DETECTIONS
+
+    two_det_obs = n_detectors_on_and_obs == 2
+    three_det_obs = n_detectors_on_and_obs == 3
+    four_det_obs = n_detectors_on_and_obs == 4
+
+    # decide whether there is a kilnova based on remnant matter, only for
+    # the events that can be counted
+    has_ejecta_bool = np.zeros(n_events, dtype=bool)
+    for i in np.flatnonzero(gw_detected):
+        has_ejecta_bool[i] = has_ejecta_mass(mass1[i], mass2[i])
+
+    em_bool = obsmag < 22.
+
+    # whether this event was not affected by then sun
+    em_bool[em_bool] = rng.random(np.count_nonzero(em_bool)) >= args.sun_loss
+    em_good = em_bool & has_ejecta_bool
+
+    n2_gw = np.count_nonzero(two_det_obs)
+    n2_good = two_det_obs & em_good
+    n2 = np.count_nonzero(n2_good)
+    # sanity check
+    assert n2_gw >= n2, "GW events ({}) less than EM follow events ({})".format(n2_gw, n2)
+    n3_gw = np.count_nonzero(three_det_obs)
+    n3_good = three_det_obs & em_good
+    n3 = np.count_nonzero(n3_good)
+    # sanity check
+    assert n3_gw >= n3, "GW events ({}) less than EM follow events ({})".format(n3_gw, n3)
+    n4_gw = np.count_nonzero(four_det_obs)
+    n4_good = four_det_obs & em_good
+    n4 = np.count_nonzero(n4_good)
+    # sanity check
+    assert n4_gw >= n4, "GW events ({}) less than EM follow events ({})".format(n4_gw, n4)
+    return dist[n2_good], tot_mass[n2_good],\
+        dist[n3_good], tot_mass[n3_good],\
+        dist[n4_good], tot_mass[n4_good],\
+        obsmag[n2_good], obsmag[n3_good],\
+        obsmag[n3_good], obsmagf200w[n2_good],\
+        obsmagf200w[n3_good], obsmagf200w[n4_good],\
+        n2, n3, n4
+
+
+def dotry_batch(trials, setup):
+    """
+    Run a contiguous block of trials as one pool task, so the setup is sent
+    to a worker once per block rather than once per trial
+    """
+    return [dotry(n, setup) for n in trials]
+
+
+def get_kde(data, grid):
+    """
+    Evaluate a Gaussian KDE (Scott's rule bandwidth) of the data on the grid
+    using an FFT-based estimator, which scales as O(N + M) instead of O(N*M)
+    """
+    from KDEpy import FFTKDE
+    data = np.asarray(data)
+    if data.size < 2:
+        raise ValueError("Need at least two points to create a KDE")
+    # KDEpy picks an equidistant grid that covers the data, so interpolate
+    # from it rather than requiring the plotting grid to contain all points
+    x, y = FFTKDE(kernel='gaussian', bw='scott').fit(data).evaluate(2**12)
+    return np.interp(grid, x, y, left=0., right=0.)
+
+
 class MinZeroAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         if values <= 0 :
@@ -140,6 +390,7 @@ def get_options(argv=None):
     parser.add_argument('--ldutycycle', default=0.8, action=MinZeroAction, type=float, help='Set the Livingston duty cycle')
     parser.add_argument('--vdutycycle', default=0.75, action=MinZeroAction, type=float, help='Set the Virgo duty cycle')
     parser.add_argument('--kdutycycle', default=0.4, action=MinZeroAction, type=float, help='Set the Kagra duty cycle')
+    parser.add_argument('--nproc', default=os.cpu_count(), type=int, action=MinZeroAction, help='Set the number of processes running MC samples')
     # duty factor motivation: https://dcc.ligo.org/public/0167/G2000497/002/G2000497_OpenLVEM_02Apr2020_kk_v2.pdf
     args = parser.parse_args(args=argv)
     return args
@@ -147,8 +398,11 @@ def get_options(argv=None):
 
 def main(argv=None):
 
+    # only needed here, so workers and imports of this module skip them
+    import matplotlib.pyplot as plt
+    import schwimmbad
+
     args = get_options(argv=argv)
-    np.random.seed(seed=42)
 
     # setup time-ranges
     ligo_run_start = Time('2022-06-01T00:00:00.0')
@@ -164,188 +418,51 @@ def main(argv=None):
     td = (earliest_end - latest_start) + eng_time
     fractional_duration = (td/(1.*u.year)).decompose().value
 
-    box_size = args.box_size
-    volume = box_size**3
-    # create the mass distribution of the merging neutron star
-    mass_distrib = args.mass_distrib
-    # the truncated normal distribution looks to be from:
-    # https://arxiv.org/pdf/1309.6635.pdf
-    mean_mass = args.masskey1
-    sig_mass  = args.masskey2
-
-    min_mass = args.masskey1
-    max_mass = args.masskey2
-
     # the two ligo detectors ahve strongly correlated duty cycles
     # they are both not very correlated with Virgo
     lvc_cor_matrix = np.array([[1., 0.8, 0.5, 0.2],
                                [0.8, 1., 0.5, 0.2],
                                [0.5, 0.5, 1., 0.2],
                                [0.2, 0.2, 0.2, 1.]])
-    upper_chol = cholesky(lvc_cor_matrix)
-
-    # setup duty cycles
-    h_duty = args.hdutycycle
-    l_duty = args.ldutycycle
-    v_duty = args.vdutycycle
-    k_duty = args.kdutycycle
+    # single precision is plenty for thresholding duty cycles, and halves
+    # the memory traffic of the correlated draws
+    upper_chol = cholesky(lvc_cor_matrix).astype(np.float32)
 
-    # setup event rates
-    mean_lograte = args.mean_lograte
-    sig_lograte  = args.sig_lograte
     n_try = args.ntry
 
     temp = at.Table.read('kilonova_phottable_40Mpc.txt', format='ascii')
-    phase = temp['ofphase']
+    temp.sort('ofphase')
+    phase = np.asarray(temp['ofphase'])
     temphmag  = temp['f160w']
     tempf200w = temp['f218w']
     temprmag  = temp['f625w']
+    # light curves relative to their brightest point, flat at early phases
+    hmag = np.asarray(temphmag) - np.min(temphmag)
+    hmag[phase < 2.5] = 0
+    f200mag = np.asarray(tempf200w) - np.min(tempf200w)
+    f200mag[phase < 2.5] = 0
 
     # define ranges
-    ligo_range = get_range('ligo')
-    virgo_range = get_range('virgo')
-    kagra_range = get_range('kagra')
+    bns_range = get_range_interpolator(('ligo', 'virgo', 'kagra'), get_mass_grid(args))
     
-    def dotry(n):
-        rate = 10.**(np.random.normal(mean_lograte, sig_lograte))
-        n_events = np.around(rate*volume*fractional_duration).astype('int')
-        if n_events == 0:
-                return tuple(0 for _ in range(15))  # FIXME: fix to prevent unpacking error
-        print(f"### Num trial = {n}; Num events = {n_events}")
-        if mass_distrib == 'mw':
-            mass1 = spstat.truncnorm.rvs(0, np.inf, args.masskey1, args.masskey2, n_events)  # FIXME: Unbound local error
-            mass2 = spstat.truncnorm.rvs(0, np.inf, args.masskey1, args.masskey2, n_events)
-        elif mass_distrib == 'msp':
-            print("MSP population chosen, overriding mean_mass and sig_mass if supplied.")
-            # numbers from https://arxiv.org/pdf/1605.01665.pdf
-            # two modes, choose a random one each time
-            mean_mass, sig_mass = random.choice([(1.393, 0.064), (1.807, 0.177)])
-            mass1 = spstat.truncnorm.rvs(0, np.inf, mean_mass, sig_mass, n_events)
-            mass2 = spstat.truncnorm.rvs(0, np.inf, mean_mass, sig_mass, n_events)
-        else:
-            print("Flat population chosen.")
-            mass1 = np.random.uniform(min_mass, max_mass, n_events)
-            mass2 = np.random.uniform(min_mass, max_mass, n_events)
-        bns_range_ligo = np.array(
-            [ligo_range(m1=m1, m2=m2) for m1, m2 in zip(mass1, mass2)]
-        ) * u.Mpc
-        bns_range_virgo = np.array(
-            [virgo_range(m1=m1, m2=m2) for m1, m2 in zip(mass1, mass2)]
-        ) * u.Mpc
-        bns_range_kagra = np.array(
-            [kagra_range(m1=m1, m2=m2) for m1, m2 in zip(mass1, mass2)]
-        ) * u.Mpc
-        tot_mass = mass1 + mass2
-
-        delay = np.random.uniform(0, 365.25, n_events)
-        delay[delay > 90] = 0
-
-        av = np.random.exponential(1, n_events)*0.4
-        ah = av/6.1
-
-        sss17a = -16.9 #H-band
-        sss17a_r = -15.8 #Rband
-        sss17a_f200 = -15.4591
-        minmag = -14.7
-        maxmag = sss17a - 2.
-
-        hmag = temphmag - min(temphmag)
-        hmag[phase < 2.5] = 0
-        f200mag = tempf200w - min(tempf200w)
-        f200mag[phase < 2.5] = 0
-
-        magindex = [(phase - x).argmin() for x in delay]
-        magindex = np.array(magindex)
-
-        default_value= [0,]
-        if n_events == 0:
-            return default_value, default_value, default_value, default_value, default_value, default_value, 0, 0
-
-        absm = np.random.uniform(0, 1, n_events)*abs(maxmag-minmag) + sss17a + hmag[magindex] + ah
-        absm = np.array(absm)
-
-        absm_f200w = np.random.uniform(0, 1, n_events)*abs(maxmag-minmag) + sss17a_f200 + f200mag[magindex]
-        absm_f200w = np.array(absm_f200w)
-
-        # simulate coordinates
-        x = np.random.uniform(-box_size/2., box_size/2., n_events)*u.megaparsec
-        y = np.random.uniform(-box_size/2., box_size/2., n_events)*u.megaparsec
-        z = np.random.uniform(-box_size/2., box_size/2., n_events)*u.megaparsec
-        dist = (x**2. + y**2. + z**2. + (0.05*u.megaparsec)**2.)**0.5
-
-        h_on, l_on, v_on, k_on = get_sim_dutycycles(n_events, upper_chol,
-                                                    h_duty, l_duty, v_duty, k_duty)
-        n_detectors_on = np.array(
-            [sum(_) for _ in np.vstack((h_on, l_on, v_on, k_on)).T]
-        )
-        # which detectors observed
-        dist_ligo_bool  = dist <= bns_range_ligo
-        dist_virgo_bool = dist <= bns_range_virgo
-        dist_kagra_bool = dist <= bns_range_kagra
-
-        h_on_and_observed = h_on * dist_ligo_bool
-        l_on_and_observed = l_on * dist_ligo_bool
-        v_on_and_observed = v_on * dist_virgo_bool
-        k_on_and_observed = k_on * dist_kagra_bool
-
-        n_detectors_on_and_obs = np.sum(np.vstack(
-            (h_on_and_observed, l_on_and_observed, v_on_and_observed,
-             k_on_and_observed)).T,
-            axis=1
-        )
-
-        two_det_obs = n_detectors_on_and_obs == 2
-        three_det_obs = n_detectors_on_and_obs == 3
-        four_det_obs = n_detectors_on_and_obs == 4
-
-        # decide whether there is a kilnova based on remnant matter
-        has_ejecta_bool = [
-            has_ejecta_mass(m1, m2) for m1, m2 in zip(mass1, mass2)
-        ]
-
-        distmod = Distance(dist)
-        obsmag = absm + distmod.distmod.value
-        obsmagf200w = absm_f200w + distmod.distmod.value
-        em_bool = obsmag < 22.
-
-        # whether this event was not affected by then sun
-        detected_events = np.where(em_bool)
-        sun_bool = np.random.random(len(detected_events[0])) >= args.sun_loss
-        em_bool[detected_events] = sun_bool
-
-        n2_gw_only = np.where(two_det_obs)[0]
-        n2_gw = len(n2_gw_only)
-        n2_good = np.where(two_det_obs & em_bool & has_ejecta_bool)[0]
-        n2 = len(n2_good)
-        # sanity check
-        assert n2_gw >= n2, "GW events ({}) less than EM follow events ({})".format(n2_gw, n2)
-        n3_gw_only = np.where(three_det_obs)[0]
-        n3_gw = len(n3_gw_only)
-        n3_good = np.where(three_det_obs & em_bool & has_ejecta_bool)[0]
-        n3 = len(n3_good)
-        # sanity check
-        assert n3_gw >= n3, "GW events ({}) less than EM follow events ({})".format(n3_gw, n3)
-        n4_gw_only = np.where(four_det_obs)[0]
-        n4_gw = len(n4_gw_only)
-        n4_good = np.where(four_det_obs & em_bool & has_ejecta_bool)[0]
-        n4 = len(n4_good)
-        # sanity check
-        assert n4_gw >= n4, "GW events ({}) less than EM follow events ({})".format(n4_gw, n4)
-        return dist[n2_good].value.tolist(), tot_mass[n2_good].tolist(),\
-            dist[n3_good].value.tolist(), tot_mass[n3_good].tolist(),\
-            dist[n4_good].value.tolist(), tot_mass[n4_good].tolist(),\
-            obsmag[n2_good].tolist(), obsmag[n3_good].tolist(),\
-            obsmag[n3_good].tolist(), obsmagf200w[n2_good].tolist(),\
-            obsmagf200w[n3_good].tolist(), obsmagf200w[n4_good].tolist(),\
-            n2, n3, n4
-
-    with schwimmbad.SerialPool() as pool:
-        values = list(pool.map(dotry, range(n_try)))
+    setup = TrialSetup(args=args, seed=42,
+                       fractional_duration=fractional_duration,
+                       upper_chol=upper_chol, phase=phase,
+                       hmag=hmag, f200mag=f200mag,
+                       bns_range=bns_range)
+    # hand each worker a few contiguous blocks of trials
+    batch_size = max(1, n_try // (4*args.nproc))
+    batches = [range(start, min(start + batch_size, n_try))
+               for start in range(0, n_try, batch_size)]
+    with schwimmbad.choose_pool(processes=args.nproc) as pool:
+        values = [value for batch in pool.map(partial(dotry_batch, setup=setup), batches)
+                  for value in batch]
     print("Finshed computation, plotting...")
     data_dump = dict()
-    n_detect2 = []
-    n_detect3 = []
-    n_detect4 = []
+    # one count per trial, so these can be allocated up front
+    n_detect2 = np.zeros(n_try, dtype=int)
+    n_detect3 = np.zeros(n_try, dtype=int)
+    n_detect4 = np.zeros(n_try, dtype=int)
     dist_detect2 = []
     mass_detect2 = []
     dist_detect3 = []
@@ -356,24 +473,19 @@ def main(argv=None):
     hmag_detect3 = []
     hmag_detect4 = []
     for idx, (d2, m2, d3, m3, d4, m4, h2, h3, h4, f2, f3, f4, n2, n3, n4) in enumerate(values):
-        if n2 >= 0:
-            n_detect2.append(n2)
-            if n3>0:
-                dist_detect2 += d2
-                mass_detect2 += m2
-                hmag_detect2 += f2
-        if n3>=0:
-            n_detect3.append(n3)
-            if n3 > 0:
-                dist_detect3 += d3
-                mass_detect3 += m3
-                hmag_detect3 += f3
-        if n4>=0:
-            n_detect4.append(n4)
-            if n4 > 0:
-                dist_detect4 += d4
-                mass_detect4 += m4
-                hmag_detect4 += f4
+        n_detect2[idx] = n2
+        n_detect3[idx] = n3
+        n_detect4[idx] = n4
+        # trials without detections add empty arrays, which concatenate away
+        dist_detect2.append(d2)
+        mass_detect2.append(m2)
+        hmag_detect2.append(f2)
+        dist_detect3.append(d3)
+        mass_detect3.append(m3)
+        hmag_detect3.append(f3)
+        dist_detect4.append(d4)
+        mass_detect4.append(m4)
+        hmag_detect4.append(f4)
         data_dump[f"{idx}"] = {"d2": d2, "m2": m2, "d3": d3,
                                "m3": m3, "d4": d4, "m4": m4,
                                "h2": h2, "h3": h3, "h4": h4,
@@ -382,9 +494,15 @@ def main(argv=None):
     with open(f"data-dump-{args.mass_distrib}.pickle", "wb") as f:
         pickle.dump(data_dump, f)
 
-    n_detect2 = np.array(n_detect2)
-    n_detect3 = np.array(n_detect3)
-    n_detect4 = np.array(n_detect4)
+    # join the per-trial arrays in one go
+    dist_detect2, dist_detect3, dist_detect4,\
+        mass_detect2, mass_detect3, mass_detect4,\
+        hmag_detect2, hmag_detect3, hmag_detect4 = (
+            np.concatenate(arrays)
+            for arrays in (dist_detect2, dist_detect3, dist_detect4,
+                           mass_detect2, mass_detect3, mass_detect4,
+                           hmag_detect2, hmag_detect3, hmag_detect4)
+        )
 
     #print(f"2 det: {n_detect2};\n3 det: {n_detect3};\n4 det: {n_detect4}")
     #print(f"2 det mean: {np.mean(n_detect2)};\n3 det mean: {np.mean(n_detect3)};\n4 det mean: {np.mean(n_detect4)}")
@@ -458,8 +576,7 @@ def main(argv=None):
     patches = list()
     legend_text = list()
     try:
-        kde = spstat.gaussian_kde(dist_detect2, bw_method='scott')
-        pdist = kde(dist_range)
+        pdist = get_kde(dist_detect2, dist_range)
         axes[1].plot(dist_range, pdist, color='C0', linestyle='-', lw=3, zorder=4)
         patch1 = axes[1].fill_between(dist_range, np.zeros(len(dist_range)), pdist, color='C0', alpha=0.3, zorder=0)
         patches.append(patch1)
@@ -477,8 +594,7 @@ def main(argv=None):
         print("Could not create KDE since no 2-det detection")
 
     try:
-        kde = spstat.gaussian_kde(dist_detect3, bw_method='scott')
-        pdist = kde(dist_range)
+        pdist = get_kde(dist_detect3, dist_range)
         axes[1].plot(dist_range, pdist, color='C1', linestyle='-', lw=3, zorder=2)
         patch2 = axes[1].fill_between(dist_range, np.zeros(len(dist_range)), pdist, color='C1', alpha=0.5, zorder=1)
         patches.append(patch2)
@@ -490,8 +606,7 @@ def main(argv=None):
         print("Could not create KDE since no 3-det detection")
 
     try:
-        kde = spstat.gaussian_kde(dist_detect4, bw_method='scott')
-        pdist = kde(dist_range)
+        pdist = get_kde(dist_detect4, dist_range)
         mean_dist = np.mean(dist_detect4)
         axes[1].plot(dist_range, pdist, color='C2', linestyle='-', lw=3, zorder=2)
         axes[1].axvline(mean_dist, color='C2', linestyle='--', lw=1.5, zorder=6, label=r'$\langle D \rangle = {:.0f}$ Mpc'.format(mean_dist))
@@ -503,15 +618,13 @@ def main(argv=None):
         print("Could not create KDE since no 4-det detection")
 
     h_range = np.arange(15, 23, 0.1)
-    kde = spstat.gaussian_kde(hmag_detect2, bw_method='scott')
-    ph = kde(h_range)
+    ph = get_kde(hmag_detect2, h_range)
     axes[2].plot(h_range, ph, color='C0', linestyle='-', lw=3, zorder=4)
     axes[2].fill_between(h_range, np.zeros(len(h_range)), ph, color='C0', alpha=0.3, zorder=0)
     mean_h = np.mean(hmag_detect2)
     axes[2].axvline(mean_h, color='C0', linestyle='--', lw=1.5, zorder=6, label=r'$\langle H \rangle = {:.1f}$ mag'.format(mean_h))
 
-    kde = spstat.gaussian_kde(hmag_detect3, bw_method='scott')
-    ph = kde(h_range)
+    ph = get_kde(hmag_detect3, h_range)
     axes[2].plot(h_range, ph, color='C1', linestyle='-', lw=3, zorder=2)
     axes[2].fill_between(h_range, np.zeros(len(h_range)), ph, color='C1', alpha=0.5, zorder=1)
     mean_h = np.mean(hmag_detect3)
@@ -519,8 +632,7 @@ def main(argv=None):
     axes[2].legend(frameon=False, fontsize='small')
 
     try:
-        kde = spstat.gaussian_kde(hmag_detect4, bw_method='scott')
-        ph = kde(h_range)
+        ph = get_kde(hmag_detect4, h_range)
         axes[2].plot(h_range, ph, color='C2', linestyle='-', lw=3, zorder=2)
         axes[2].fill_between(h_range, np.zeros(len(h_range)), ph, color='C1', alpha=0.5, zorder=1)
         mean_h = np.mean(hmag_detect4)